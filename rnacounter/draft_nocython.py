@@ -5,10 +5,10 @@
 Usage:
    rnacounter  (--version | -h)
    rnacounter  BAM GTF
-   rnacounter  [-n <int>] [-f <int>] [-s] [--nh] [--noheader] [--threshold <float>] [--exon_cutoff <int>]
-               [--gtf_ftype FTYPE] [--format FORMAT] [-t TYPE] [-c CHROMS] [-o OUTPUT] [-m METHOD]
+   rnacounter  [-n <int>] [-f <int>] [-p <int>] [-s] [--nh] [--noheader] [--threshold <float>] [--exon_cutoff <int>]
+               [--gtf_ftype FTYPE] [--format FORMAT] [-t TYPE] [-c CHROMS] [-g GENES] [-o OUTPUT] [-m METHOD]
                BAM GTF
-   rnacounter test [-s] [--nh] [-t TYPE] [-m METHOD]
+   rnacounter test [-p <int>] [-s] [--nh] [-t TYPE] [-m METHOD]
    rnacounter join [-o OUTPUT] TAB [TAB2 ...]
 
 Options:
@@ -17,6 +17,7 @@ Options:
    -s, --stranded                   Compute sense and antisense reads separately [default: False].
    -n <int>, --normalize <int>      Normalization constant for RPKM. Default: (total number of mapped reads)/10^6.
    -f <int>, --fraglength <int>     Average fragment length (for transcript length correction) [default: 1].
+   -p <int>, --nproc <int>          Number of processes, each counting one chromosome at a time [default: 1].
    --nh                             Divide count by NH flag for multiply mapping reads [default: False].
    --noheader                       Remove column names from the output (helps piping) [default: False].
    --exon_cutoff <int>              Merge transcripts differing by exons of less than that many nt [default: 0].
@@ -26,6 +27,7 @@ Options:
    -t TYPE, --type TYPE             Type of genomic features to count reads in:
                                     'genes', 'transcripts', 'exons', 'introns' or 'exon_frags' [default: genes].
    -c CHROMS, --chromosomes CHROMS  Selection of chromosome names (comma-separated list).
+   -g GENES, --genes GENES          Selection of gene IDs or names (comma-separated list).
    -o OUTPUT, --output OUTPUT       Output file to redirect stdout (optional).
    -m METHOD, --method METHOD       Counting method: 'nnls', 'raw' or 'indirect-nnls' [default: raw].
 
@@ -34,11 +36,17 @@ Full documentation available at http://bbcf.epfl.ch/bbcflib/tutorial_rnacounter.
 """
 
 import pysam
-import os, sys, itertools, copy, subprocess
+import os, sys, re, itertools, copy, subprocess
+import multiprocessing
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 from operator import attrgetter, itemgetter
-from numpy import asarray, zeros, diag, sqrt, multiply, dot
+from collections import defaultdict
+from numpy import asarray, zeros, sqrt, multiply
+import numpy as np
 from scipy.optimize import nnls
-from functools import reduce
 
 
 
@@ -52,10 +60,12 @@ from functools import reduce
 def _score(x):
     if x == '.': return 0.0
     else: return float(x)
+_strand_map = {'+':1, '1':1, '-':-1, '-1':-1, '.':0, '0':0}
 def _strand(x):
-    smap = {'+':1, '1':1, '-':-1, '-1':-1, '.':0, '0':0}
-    return smap[x]
-Ecounter = itertools.count(1)  # to give unique ids to undefined exons, see parse_gtf()
+    return _strand_map[x]
+Ecounter = itertools.count(1)  # numbers annotation lines, to give unique ids to undefined exons, see parse_gtf()
+# The only GTF attributes we use - quotes are optional
+_attrs_re = re.compile(r'(?:^|;)\s*(gene_id|gene_name|transcript_id|exon_id)\s+(?:"([^"]*)"|([^\s;]+))')
 
 def skip_header(filename):
     """Return the number of lines starting with `#`."""
@@ -65,19 +75,25 @@ def skip_header(filename):
             n += 1
     return n
 
-def parse_gtf(line, gtf_ftype):
-    """Parse one GTF line. Return None if not an 'exon'. Return False if row is empty."""
+def parse_gtf(line, gtf_ftype, genes=None):
+    """Parse one GTF line. Return None if not an 'exon', or if its gene is not in *genes*
+    (a set of gene IDs and names) when given. Return False if row is empty."""
     # GTF fields = ['chr','source','name','start','end','score','strand','frame','attributes']
     if not line: return False
+    exon_nr = next(Ecounter)  # line number, whether or not it is kept
+    if ("\t%s\t" % gtf_ftype) not in line:  # cheap reject before splitting
+        return None
     row = line.strip().split("\t")
     if len(row) < 9:
         raise ValueError("\"Attributes\" field required in GFF.")
     if row[2] != gtf_ftype:
         return None
-    attrs = tuple(x.strip().split() for x in row[8].rstrip(';').split(';'))  # {gene_id: "AAA", ...}
-    attrs = dict((x[0],x[1].strip("\"")) for x in attrs)
-    exon_nr = next(Ecounter)
-    exon_id = attrs.get('exon_id', 'E%d'%exon_nr)
+    attrs = dict((k,q or u) for k,q,u in _attrs_re.findall(row[8]))  # {gene_id: "AAA", ...}
+    if genes is not None and attrs.get('gene_id') not in genes and attrs.get('gene_name') not in genes:
+        return None
+    exon_id = attrs.get('exon_id')
+    if exon_id is None:  # only format a default name when the GTF has no exon_id
+        exon_id = 'E%d'%exon_nr
     start = max(int(row[3])-1,0)
     end = max(int(row[4]),0)
     return GenomicObject(id=(exon_nr,),
@@ -86,20 +102,24 @@ def parse_gtf(line, gtf_ftype):
         name=exon_id, strand=_strand(row[6]), ftype="exon",
         transcripts=set([attrs.get('transcript_id',exon_id)]))
 
-def parse_bed(line, gtf_ftype):
-    """Parse one BED line. Return False if *line* is empty."""
-    if (not line) or (line[0]=='#') or (line[:5]=='track'): return False
+def parse_bed(line, gtf_ftype, genes=None):
+    """Parse one BED line. Return None if its name is not in *genes*, when given.
+    Return False if *line* is empty."""
+    if (not line): return False
+    exon_nr = next(Ecounter)  # line number, whether or not it is kept
+    if (line[0]=='#') or (line[:5]=='track'): return False
     row = line.strip().split()
     lrow = len(row)
     assert lrow >=4, "Input BED format requires at least 4 fields: %s" % line
     chrom = row[0]; start = int(row[1]); end = int(row[2]); name = row[3]
+    if genes is not None and name not in genes:
+        return None
     strand = 0
     if lrow > 4:
         if lrow > 5: strand = _strand(row[5])
         else: strand = 0
         score = _score(row[4])
     else: score = 0.0
-    exon_nr = next(Ecounter)
     return GenomicObject(id=(exon_nr,), gene_id=name, gene_name=name,
         chrom=chrom, start=start, end=end, length=end-start,
         name=name, score=score, strand=strand, ftype="exon", transcripts=set([name]))
@@ -145,13 +165,9 @@ def join(tables, output):
 #########################  Global classes  ##########################
 
 
-class Counter(object):
-    def __init__(self):
-        self.n = 0
-    def __call__(self, alignment):
-        self.n += 1
-
 class GenomicObject(object):
+    __slots__ = ('id','gene_id','gene_name','chrom','start','end','name','ftype','score','strand',
+                 'count','count_anti','rpk','rpk_anti','synonyms','transcripts','exons','length')
     def __init__(self, id=(0,),gene_id='',gene_name='',chrom='',start=0,end=0,
                  name='',score=0.0,strand=0,length=0,ftype='',
                  count=0,count_anti=0,rpk=0.0,rpk_anti=0.0,synonyms='.',
@@ -179,8 +195,8 @@ class GenomicObject(object):
         """The intersection of two GenomicObjects"""
         return GenomicObject(
             id = self.id + other.id,
-            gene_id = '|'.join(set([self.gene_id, other.gene_id])),
-            gene_name = '|'.join(set([self.gene_name, other.gene_name])),
+            gene_id = '|'.join(sorted(set([self.gene_id, other.gene_id]))),
+            gene_name = '|'.join(sorted(set([self.gene_name, other.gene_name]))),
             chrom = self.chrom,
             ##   name = '|'.join(set([self.name, other.name])),
             name = '|'.join([self.name, other.name]),
@@ -189,18 +205,11 @@ class GenomicObject(object):
             ftype = "exon"
         )
 
-    def increment(self, x, alignment, multiple, stranded):
-        if multiple:
-            NH = 1.0
-            for (k,v) in alignment.tags:
-                if k=='NH':
-                    NH = 1.0/v
-                    break
-            x = x * NH
+    def increment(self, x, reverse, stranded):
+        """Add *x* to the count. *reverse* is the read strand, used if *stranded*."""
         if stranded:
             # read/exon strand mismatch
-            if (alignment.is_reverse is False and self.strand == 1) \
-            or (alignment.is_reverse is True and self.strand == -1):
+            if (not reverse and self.strand == 1) or (reverse and self.strand == -1):
                 self.count += x
             else:
                 self.count_anti += x
@@ -215,33 +224,61 @@ class GenomicObject(object):
 
 
 def intersect_exons_list(feats):
-    """The intersection of a list *feats* of GenomicObjects. Pieces are unique."""
+    """The intersection of a list *feats* of GenomicObjects. Pieces are unique.
+    Same as reducing with `&`, but builds a single object in one pass."""
     feats = list(set(feats))
-    f = feats[0]
-    if len(feats) == 1:
-        return f.__and__(f)
-    else:
-        return reduce(GenomicObject.__and__, feats)
+    f0 = feats[0]
+    if len(feats) == 1:  # a fresh copy, without the merging below
+        return GenomicObject(id=f0.id, gene_id=f0.gene_id, gene_name=f0.gene_name,
+            chrom=f0.chrom, name=f0.name, strand=f0.strand, transcripts=set(f0.transcripts), ftype="exon")
+    strand = f0.strand
+    transcripts = set(); gene_ids = set(); gene_names = set()
+    for f in feats:
+        transcripts |= f.transcripts
+        gene_ids.add(f.gene_id)
+        gene_names.add(f.gene_name)
+        if f.strand != strand: strand = 0
+    return GenomicObject(
+        id = tuple(itertools.chain.from_iterable(f.id for f in feats)),
+        gene_id = '|'.join(sorted(gene_ids)),
+        gene_name = '|'.join(sorted(gene_names)),
+        chrom = f0.chrom,
+        name = '|'.join(f.name for f in feats),
+        strand = strand,
+        transcripts = transcripts,
+        ftype = "exon"
+    )
 
 def cobble(exons):
     """Split exons into non-overlapping parts."""
-    ends = [(e.start,1,e) for e in exons] + [(e.end,0,e) for e in exons]
-    ends.sort()
-    active_exons = []
+    n = len(exons)
+    if n == 0: return []
+    # Boundaries: starts at [0,n), ends at [n,2n). Sorted by position, ends before starts.
+    pos = np.array([e.start for e in exons] + [e.end for e in exons], dtype=np.int64)
+    order = np.lexsort((np.repeat(np.array([1,0], dtype=np.int8), n), pos)).tolist()
+    pos = pos.tolist()
+    active = set()  # indices of the exons overlapping the current position
+    cache = {}      # {frozenset(active): intersection} - nested exons give back the same set
     cobbled = []
-    for i in range(len(ends)-1):
-        a = ends[i]
-        b = ends[i+1]
-        if a[1]==1:
-            active_exons.append(a[2])
-        elif a[1]==0:
-            active_exons.remove(a[2])
-        if len(active_exons)==0:
+    for k in range(2*n-1):
+        i = order[k]
+        j = order[k+1]
+        if i < n:
+            active.add(i)
+        else:
+            active.discard(i-n)
+        if not active:
             continue
-        if a[0]==b[0]:
+        if pos[i] == pos[j]:
             continue
-        e = intersect_exons_list(active_exons)
-        e.start = a[0]; e.end = b[0]; e.length = b[0]-a[0]
+        key = frozenset(active)
+        if key in cache:
+            e = copy.copy(cache[key])
+            e.transcripts = set(e.transcripts)
+        else:
+            e = intersect_exons_list([exons[x] for x in active])
+            cache[key] = e
+        e.start = pos[i]; e.end = pos[j]; e.length = pos[j]-pos[i]
         cobbled.append(e)
     return cobbled
 
@@ -267,7 +304,7 @@ def partition_chrexons(chrexons):
     lastgeneids = set([chrexons[0].gene_id])
     lastindex = 0
     partition = []
-    pinvgenes = {}  # map {gene_id: partitions it is found in}
+    pinvgenes = defaultdict(list)  # map {gene_id: partitions it is found in}
     npart = 0       # partition index
     # First cut - where disjoint except if the same gene continues
     for i,exon in enumerate(chrexons):
@@ -276,7 +313,7 @@ def partition_chrexons(chrexons):
             partition.append((lastindex,i))
             # Record in which parts the gene was found, fuse them later
             for g in lastgeneids:
-                pinvgenes.setdefault(g,[]).append(npart)
+                pinvgenes[g].append(npart)
             npart += 1
             lastgeneids.clear()
             lastindex = i
@@ -285,9 +322,9 @@ def partition_chrexons(chrexons):
         lastgeneids.add(exon.gene_id)
     partition.append((lastindex,len(chrexons)))
     for g in lastgeneids:
-        pinvgenes.setdefault(g,[]).append(npart)
+        pinvgenes[g].append(npart)
     # Put together intervals containing parts of the same gene mixed with others - if any
-    mparts = [[p[0],p[len(p)-1]] for p in pinvgenes.itervalues() if len(p)>1]
+    mparts = [[p[0],p[len(p)-1]] for p in pinvgenes.values() if len(p)>1]
     if mparts:
         mparts = fuse(sorted(mparts))
         toremove = set()
@@ -336,17 +373,24 @@ def count_reads(exons, ckreads, multiple, stranded):
     :param stranded: for strand-specific protocols, use the strand information."""
     current_idx = 0
     nexons = len(exons)
+    if nexons == 0: return 0
+    # Pieces are disjoint and sorted, so are their ends
+    ends = [e.end for e in exons]
     for alignment in ckreads:
-        if current_idx >= nexons: return 0
-        exon_end = exons[current_idx].end
         ali_pos = alignment.pos
-        while exon_end <= ali_pos:
+        # Two-pointer sweep: reads come sorted by position, so the first piece
+        # ending after the read start can only move forward.
+        while ends[current_idx] <= ali_pos:
             current_idx += 1
             if current_idx >= nexons: return 0
-            exon_end = exons[current_idx].end
         idx2 = current_idx
         exon_start = exons[idx2].start
+        exon_end = exons[idx2].end
         read_len = alignment.rlen
+        reverse = alignment.is_reverse
+        NH = 1.0
+        if multiple and alignment.has_tag('NH'):
+            NH = 1.0/alignment.get_tag('NH')
         ali_len = 0
         for op,shift in alignment.cigar:
             # Deletion is "from the reference", insert is "to the reference"
@@ -361,7 +405,7 @@ def count_reads(exons, ckreads, multiple, stranded):
                     # Score up to exon end, go to exon end, remove from shift and reset ali_len
                     if op == 0:
                         ali_len += exon_end - ali_pos
-                        exons[idx2].increment(float(ali_len)/float(read_len), alignment, multiple,stranded)
+                        exons[idx2].increment(float(ali_len)/float(read_len)*NH, reverse,stranded)
                     shift -= exon_end-ali_pos
                     ali_pos = exon_end
                     ali_len = 0
@@ -383,20 +427,29 @@ def count_reads(exons, ckreads, multiple, stranded):
             elif op == 1:  # BAM_CINS
                 ali_len += shift;
         # If read entirely contained in exon, ali_len==shift and we do a single increment
-        exons[idx2].increment(float(ali_len)/float(read_len), alignment, multiple,stranded)
+        exons[idx2].increment(float(ali_len)/float(read_len)*NH, reverse,stranded)
 
 
 ######################  Expression inference  #######################
 
 
-def is_in(ftype,x,feat_id):
-    """Returns True if GenomicObject *x* is part of the gene/transcript *feat_id*."""
+def feat_ids(ftype,x):
+    """Returns the IDs of all genes/transcripts GenomicObject *x* is part of."""
     if ftype == "transcript":
-        return feat_id in x.transcripts
+        return x.transcripts
     elif ftype == "gene":
-        return feat_id in x.gene_id.split('|')
+        return x.gene_id.split('|')
     else:
-        return feat_id in x.name.split('|')
+        return x.name.split('|')
+def group_by_feat(ftype, objs):
+    """Returns a map {feat_id: [objects of *objs* that are part of it]}, in the order
+    of *objs*. Built in one pass instead of scanning *objs* again for every ID."""
+    groups = defaultdict(list)
+    for x in objs:
+        for f in set(feat_ids(ftype,x)):
+            groups[f].append(x)
+    return groups
+
 
 def estimate_expression_NNLS(ftype, pieces, ids, exons, norm_cst, stranded):
     #--- Build the exons-transcripts structure matrix:
@@ -404,16 +457,22 @@ def estimate_expression_NNLS(ftype, pieces, ids, exons, norm_cst, stranded):
     # so that A[i,j]!=0 means "transcript Tj contains exon Ei".
     n = len(pieces)
     m = len(ids)
-    A = zeros((n,m))
+    # Scatter ones at (piece, feature) pairs instead of testing all n*m cells
+    fidx = defaultdict(list)  # {feat_id: [column indices]}
+    for j,f in enumerate(ids):
+        fidx[f].append(j)
+    rows = []; cols = []
     for i,p in enumerate(pieces):
-        for j,f in enumerate(ids):
-            A[i,j] = 1. if is_in(ftype,p,f) else 0.
+        for f in feat_ids(ftype,p):
+            for j in fidx.get(f,()):
+                rows.append(i); cols.append(j)
+    S = zeros((n,m), dtype=np.float32)  # 0/1 entries, exact in single precision
+    S[rows,cols] = 1.
     #--- Build the exons RPKs vector
     E = asarray([p.rpk for p in pieces])
     # Weights
     w = sqrt(asarray([p.length for p in pieces]))
-    W = diag(w)
-    A = dot(W,A)
+    A = S * w[:,None]  # same as dot(diag(w),S), without the n*n diagonal matrix
     E = multiply(E, w)
     #--- Solve for transcripts RPK
     T,rnorm = nnls(A,E)
@@ -424,9 +483,11 @@ def estimate_expression_NNLS(ftype, pieces, ids, exons, norm_cst, stranded):
     #--- Store result in *feat_class* objects
     feats = []
     frpk_anti = fcount_anti = 0.0
+    f2e = group_by_feat(ftype,exons)
+    f2p = group_by_feat(ftype,pieces)
     for i,f in enumerate(ids):
-        exs = sorted([e for e in exons if is_in(ftype,e,f)], key=attrgetter('start','end'))
-        inner = [p for p in pieces if is_in(ftype,p,f)]
+        exs = sorted(f2e[f], key=attrgetter('start','end'))
+        inner = f2p[f]
         flen = sum([p.length for p in cobble(inner)])
         frpk = T[i]
         fcount = fromRPK(T[i],flen,norm_cst)
@@ -446,9 +507,11 @@ def estimate_expression_raw(ftype, pieces, ids, exons, norm_cst, stranded):
     commonly does for genes from exon counts."""
     feats = []
     frpk_anti = fcount_anti = 0.0
+    f2e = group_by_feat(ftype,exons)
+    f2p = group_by_feat(ftype,[p for p in pieces if '|' not in p.gene_id])
     for i,f in enumerate(ids):
-        exs = sorted([e for e in exons if is_in(ftype,e,f)], key=attrgetter('start','end'))
-        inner = [p for p in pieces if (len(p.gene_id.split('|'))==1 and is_in(ftype,p,f))]
+        exs = sorted(f2e[f], key=attrgetter('start','end'))
+        inner = f2p[f]
         if len(inner)==0:
             flen = 0
             fcount = frpk = 0.0
@@ -471,10 +534,11 @@ def genes_from_transcripts(transcripts, pieces):
     """Used in 'indirect-nnls' mode."""
     genes = []
     transcripts.sort(key=attrgetter("gene_id","start","end"))
+    g2p = group_by_feat("gene",pieces)
     for k,group in itertools.groupby(transcripts, key=attrgetter("gene_id")):
         g = list(group)
         t0 = g[0]
-        inner = [p for p in pieces if is_in("gene",p,k)]
+        inner = g2p[k]
         glen = sum([p.length for p in cobble(inner)])
         genes.append(GenomicObject(name=t0.gene_id, ftype="gene",
                 rpk=sum([x.rpk for x in g]), rpk_anti=sum([x.rpk_anti for x in g]),
@@ -496,11 +560,11 @@ def filter_transcripts(t2p, exon_cutoff):
     """*t2p* is a map {transcriptID: [exon pieces]}.
     Find transcripts that differ from others by exon parts of less than
     one read length."""
-    structs = {}  # transcript structures, as tuples of exon ids
+    structs = defaultdict(list)  # transcript structures, as tuples of exon ids
     replace = {} # too close transcripts
     for t,texons in sorted(t2p.items(), key=itemgetter(0)):
         structure = tuple([te.id for te in texons if te.length > exon_cutoff])
-        structs.setdefault(structure, []).append(t)
+        structs[structure].append(t)
     for f,tlist in structs.items():
         tlist.sort()
         main = tlist[0]
@@ -526,38 +590,36 @@ def process_chunk(ckexons, sam, chrom, options):
 
     #--- Regroup occurrences of the same exon from a different transcript
     exons = []
+    gids = set(); exon_names = set()
     for key,group in itertools.groupby(ckexons, attrgetter('name')):
         # ckexons are sorted by id/name because chrexons were sorted by chrom,start,end
         exon0 = next(group)
         for gr in group:
             exon0.transcripts.add(gr.transcripts.pop())
         exons.append(exon0)
-    gene_ids = sorted(set(e.gene_id for e in exons)) # sort to have the same order in all outputs from same gtf
-    exon_names = sorted(set(e.name for e in exons))
+        gids.add(exon0.gene_id)
+        exon_names.add(exon0.name)
+    gene_ids = sorted(gids) # sort to have the same order in all outputs from same gtf
 
     #--- Cobble all these intervals
     pieces = cobble(exons)  # sorted
 
     #--- Filter out too similar transcripts
-    t2p = {}
-    synonyms = {}
-    for p in pieces:
+    t2p = defaultdict(list)
+    synonyms = defaultdict(set)
+    for p in pieces:  # single walk over the pieces
+        p.name = simplify(p.name)  # remove duplicates in names
         for t in p.transcripts:
-            t2p.setdefault(t,[]).append(p)
+            t2p[t].append(p)
     if (1 in types) or (3 in types) or (0 in types and methods[0]==2):
         replace = filter_transcripts(t2p, exon_cutoff)
         for p in pieces + exons:
             p.transcripts = set(replace[t] for t in p.transcripts)
-        for t,main in replace.iteritems():
-            synonyms.setdefault(main, set()).add(t)
+        for t,main in replace.items():
+            synonyms[main].add(t)
     transcript_ids = sorted(t2p.keys())  # sort to have the same order in all outputs from same gtf
 
-    #--- Count reads in each piece
-    lastend = max(e.end for e in exons)
-    ckreads = sam.fetch(chrom, exons[0].start, lastend)
-    count_reads(pieces,ckreads,options['nh'],stranded)
-
-    #--- Same for introns, if selected
+    #--- Build intron pieces, if selected
     intron_pieces = []
     if 3 in types:
         introns = []
@@ -569,23 +631,26 @@ def process_chunk(ckexons, sam, chrom, options):
             intron_pieces = [ip for ip in intron_exon_pieces if \
                              # ip.length > exon_cutoff and \
                              not any([n in exon_names for n in ip.name.split('|')])]
-            if intron_pieces:
-                lastend = max([intron.end for intron in introns])
-                ckreads = sam.fetch(chrom, intron_pieces[0].start, lastend)
-                count_reads(intron_pieces,ckreads,options['nh'],stranded)
         for i,ip in enumerate(intron_pieces):
             ip.ftype = "intron"
 
+    #--- Count reads in each piece - a single fetch, since introns lie within [exons[0].start, lastend]
+    lastend = max(e.end for e in exons)
+    ckreads = list(sam.fetch(chrom, exons[0].start, lastend))
+    count_reads(pieces,ckreads,options['nh'],stranded)
+    if intron_pieces:
+        # Separate pass: count_reads carries a read over to the next pieces, which must not
+        # mix exons and introns. Skip the reads that end before the first intron.
+        count_reads(intron_pieces,[r for r in ckreads if r.aend > intron_pieces[0].start],
+                    options['nh'],stranded)
+
     #--- Calculate RPK
     for p in itertools.chain(pieces,intron_pieces):
         p.rpk = toRPK(p.count,p.length,norm_cst)
-    if stranded:
-        for p in itertools.chain(pieces,intron_pieces):
+        if stranded:
             p.rpk_anti = toRPK(p.count_anti,p.length,norm_cst)
 
     #--- Infer gene/transcript counts
-    for p in pieces:
-        p.name = simplify(p.name)  # remove duplicates in names
     genes=[]; transcripts=[]; exons2=[]; introns2=[]; pieces2=[]
     # Transcripts - 1
     if 1 in types:
@@ -667,6 +732,63 @@ def write_output(output, genes,transcripts,exons,introns,pieces, threshold,stran
             output.write('\t'.join(towrite)+'\n')
 
 
+def process_chrexons(chrexons, sam, chrom, options):
+    """Partition all exons *chrexons* of chromosome *chrom* in independent chunks
+    and process each of them."""
+    chrexons.sort(key=attrgetter('start','end','name'))
+    if options['stranded']:
+        chrexons_plus = [x for x in chrexons if x.strand == 1]
+        chrexons_minus = [x for x in chrexons if x.strand == -1]
+        if len(chrexons_plus) > 0:
+            partition_plus = partition_chrexons(chrexons_plus)
+            for (a,b) in partition_plus:
+                process_chunk(chrexons_plus[a:b], sam, chrom, options)
+        if len(chrexons_minus) > 0:
+            partition_minus = partition_chrexons(chrexons_minus)
+            for (a,b) in partition_minus:
+                process_chunk(chrexons_minus[a:b], sam, chrom, options)
+    else:
+        partition = partition_chrexons(chrexons)
+        for (a,b) in partition:
+            process_chunk(chrexons[a:b], sam, chrom, options)
+
+
+def chrom_rows(annot, chromosomes):
+    """Group the non-empty lines of *annot* by chromosome, keeping those in *chromosomes*.
+    Yields tuples (chrom, rows, first) where *first* is the number of the first of *rows*
+    in the annotation, as counted by parse_gtf() and parse_bed() (see Ecounter)."""
+    rows = enumerate((row for row in annot if row.strip()), 1)
+    for chrom,chrrows in itertools.groupby(rows, lambda x: x[1].split(None,1)[0]):
+        if chrom in chromosomes:
+            chrrows = list(chrrows)
+            yield chrom, [row for i,row in chrrows], chrrows[0][0]
+
+def parse_chrom_rows(rows, first, options):
+    """Parse the annotation lines *rows* of one chromosome, the first one being
+    line number *first*. Returns the usable exons."""
+    global Ecounter
+    Ecounter = itertools.count(first)  # same default exon ids whatever is parsed before
+    if options['format'] == 'gtf':
+        parse = parse_gtf
+    elif options['format'] == 'bed':
+        parse = parse_bed
+    chrexons = (parse(row.strip(), options['gtf_ftype'], options['genes']) for row in rows)
+    return [e for e in chrexons if e and (e.end - e.start > 1)]
+
+def process_chrom_rows(job):
+    """Used with --nproc > 1. *job* is a tuple (bamname, chrom, rows, first, options),
+    see chrom_rows(). Returns what would have been written to the output, as a string,
+    and the number of exons parsed."""
+    bamname, chrom, rows, first, options = job
+    chrexons = parse_chrom_rows(rows, first, options)
+    options['output'] = StringIO()
+    if chrexons:
+        sam = pysam.Samfile(bamname, "rb")  # pysam handles cannot be shared between processes
+        process_chrexons(chrexons, sam, chrom, options)
+        sam.close()
+    return options['output'].getvalue(), len(chrexons)
+
+
 def rnacounter_main(bamname, annotname, options):
     # Index BAM if necessary
     if not os.path.exists(bamname+'.bai'):
@@ -687,16 +809,11 @@ def rnacounter_main(bamname, annotname, options):
     for _ in range(nhead): annot.readline()
 
     if options['output'] is None: options['output'] = sys.stdout
-    else: options['output'] = open(options['output'], "wb")
+    else: options['output'] = open(options['output'], "w")
     if options['noheader'] is False:
         header = ['ID','Count','RPKM','Chrom','Start','End','Strand','GeneName','Length','Type','Sense','Synonyms']
         options['output'].write('\t'.join(header)+'\n')
 
-    if options['format'] == 'gtf':
-        parse = parse_gtf
-    elif options['format'] == 'bed':
-        parse = parse_bed
-
     # Cross 'chromosomes' option with available BAM headers
     if options['chromosomes']:
         chromosomes = [c for c in sam.references if c in options['chromosomes']]
@@ -710,49 +827,35 @@ def rnacounter_main(bamname, annotname, options):
         options['normalize'] = float(options['normalize'])
     options['normalize'] = 1.0
 
-    # Initialize
-    gtf_ftype = options['gtf_ftype']
-    chrom = ''
-    while chrom not in chromosomes:
-        exon = None
-        while exon is None:
-            row = annot.readline().strip()
-            exon = parse(row, gtf_ftype)
-        chrom = exon.chrom
-    lastchrom = chrom
-
     # Process together all exons of one chromosome at a time
-    while row:
-        chrexons = []
-        while chrom == lastchrom:
-            if (exon.end - exon.start > 1) and (exon.chrom in chromosomes):
-                chrexons.append(exon)
-            # Fetch next exon
-            exon = None
-            while exon is None:
-                row = annot.readline().strip()
-                exon = parse(row, gtf_ftype)  # None if not an exon, False if EOF
-            if not row: break
-            chrom = exon.chrom
-        if chrexons:
-            chrexons.sort(key=attrgetter('start','end','name'))
-            if options['stranded']:
-                chrexons_plus = [x for x in chrexons if x.strand == 1]
-                chrexons_minus = [x for x in chrexons if x.strand == -1]
-                if len(chrexons_plus) > 0:
-                    partition_plus = partition_chrexons(chrexons_plus)
-                    for (a,b) in partition_plus:
-                        process_chunk(chrexons_plus[a:b], sam, lastchrom, options)
-                if len(chrexons_minus) > 0:
-                    partition_minus = partition_chrexons(chrexons_minus)
-                    for (a,b) in partition_minus:
-                        process_chunk(chrexons_minus[a:b], sam, lastchrom, options)
-            else:
-                if len(chrexons) > 0:
-                    partition = partition_chrexons(chrexons)
-                    for (a,b) in partition:
-                        process_chunk(chrexons[a:b], sam, lastchrom, options)
-        lastchrom = chrom
+    nchrom = nexons = 0
+    if options['nproc'] > 1:
+        # Workers parse the rows of one chromosome each and open their own BAM handle;
+        # outputs are written in the order of the annotation.
+        jobs = ((bamname, chrom, rows, first, dict(options, output=None))
+                for chrom,rows,first in chrom_rows(annot, chromosomes))
+        pool = multiprocessing.Pool(options['nproc'])
+        try:
+            for out,n in pool.imap(process_chrom_rows, jobs):
+                nchrom += 1
+                nexons += n
+                options['output'].write(out)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chrom,rows,first in chrom_rows(annot, chromosomes):
+            nchrom += 1
+            chrexons = parse_chrom_rows(rows, first, options)
+            nexons += len(chrexons)
+            if chrexons:
+                process_chrexons(chrexons, sam, chrom, options)
+    if nchrom == 0:
+        raise ValueError("Reference names in BAM do not correspond to that of the GTF.")
+    if nexons == 0:
+        if options['genes'] is not None:
+            raise ValueError("No annotation line matches --genes.")
+        raise ValueError("No '%s' found in the annotation." % options['gtf_ftype'])
 
     options['output'].close()
     annot.close()
@@ -774,6 +877,7 @@ def errmsg(message):
 def parse_args(args):
     if args['--chromosomes'] is None: args['--chromosomes'] = []
     else: args['--chromosomes'] = args['--chromosomes'].split(',')
+    if args['--genes'] is not None: args['--genes'] = set(args['--genes'].split(','))
 
     if args['--format'].lower() not in ['gtf','bed']:
         errmsg("FORMAT must be one of 'gtf' or 'bed'.")
@@ -809,6 +913,8 @@ def parse_args(args):
     except ValueError: errmsg("--threshold must be numeric.")
     try: args['--fraglength'] = int(args['--fraglength'])
     except ValueError: errmsg("FRAGLENGTH must be an integer.")
+    try: args['--nproc'] = max(int(args['--nproc']), 1)
+    except ValueError: errmsg("--nproc must be an integer.")
     if args['--exon_cutoff']:
         try: args['--exon_cutoff'] = int(args['--exon_cutoff'])
         except ValueError: errmsg("--exon_cutoff must be an integer.")
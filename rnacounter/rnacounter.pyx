@@ -5,10 +5,10 @@
 Usage:
    rnacounter  (--version | -h)
    rnacounter  BAM GTF
-   rnacounter  [-n <int>] [-f <int>] [-s] [--nh] [--noheader] [--threshold <float>] [--exon_cutoff <int>]
-               [--gtf_ftype FTYPE] [--format FORMAT] [-t TYPE] [-c CHROMS] [-o OUTPUT] [-m METHOD]
+   rnacounter  [-n <int>] [-f <int>] [-p <int>] [-s] [--nh] [--noheader] [--threshold <float>] [--exon_cutoff <int>]
+               [--gtf_ftype FTYPE] [--format FORMAT] [-t TYPE] [-c CHROMS] [-g GENES] [-o OUTPUT] [-m METHOD]
                BAM GTF
-   rnacounter test [-s] [--nh] [-t TYPE] [-m METHOD]
+   rnacounter test [-p <int>] [-s] [--nh] [-t TYPE] [-m METHOD]
    rnacounter join [-o OUTPUT] TAB [TAB2 ...]
 
 Options:
@@ -17,6 +17,7 @@ Options:
    -s, --stranded                   Compute sense and antisense reads separately [default: False].
    -n <int>, --normalize <int>      Normalization constant for RPKM. Default: (total number of mapped reads)/10^6.
    -f <int>, --fraglength <int>     Average fragment length (for transcript length correction) [default: 1].
+   -p <int>, --nproc <int>          Number of processes, each counting one chromosome at a time [default: 1].
    --nh                             Divide count by NH flag for multiply mapping reads [default: False].
    --noheader                       Remove column names from the output (helps piping) [default: False].
    --exon_cutoff <int>              Merge transcripts differing by exons of less than that many nt [default: 0].
@@ -26,6 +27,7 @@ Options:
    -t TYPE, --type TYPE             Type of genomic features to count reads in:
                                     'genes', 'transcripts', 'exons', 'introns' or 'exon_frags' [default: genes].
    -c CHROMS, --chromosomes CHROMS  Selection of chromosome names (comma-separated list).
+   -g GENES, --genes GENES          Selection of gene IDs or names (comma-separated list).
    -o OUTPUT, --output OUTPUT       Output file to redirect stdout (optional).
    -m METHOD, --method METHOD       Counting method: 'nnls', 'raw' or 'indirect-nnls' [default: raw].
 
@@ -34,11 +36,16 @@ Full documentation available at http://bbcf.epfl.ch/bbcflib/tutorial_rnacounter.
 """
 
 import pysam
-import os, sys, itertools, copy, subprocess
+import os, sys, re, itertools, copy, subprocess
+import multiprocessing
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 from operator import attrgetter, itemgetter
-from numpy import array, zeros, diag, dot, multiply, sqrt
+from collections import defaultdict
+from numpy import array, zeros, multiply, sqrt
 from scipy.optimize import nnls
-from functools import reduce
 
 import numpy as np
 cimport numpy as cnp
@@ -52,10 +59,12 @@ ctypedef cnp.double_t DTYPE_t   # assign a corresponding compile-time C type to
 cdef inline double _score(str x):
     if x == '.': return 0.0
     else: return float(x)
+_strand_map = {'+':1, '1':1, '-':-1, '-1':-1, '.':0, '0':0}
 cdef inline int _strand(str x):
-    smap = {'+':1, '1':1, '-':-1, '-1':-1, '.':0, '0':0}
-    return smap[x]
-Ecounter = itertools.count(1)  # to give unique ids to undefined exons, see parse_gtf()
+    return _strand_map[x]
+Ecounter = itertools.count(1)  # numbers annotation lines, to give unique ids to undefined exons, see parse_gtf()
+# The only GTF attributes we use - quotes are optional
+_attrs_re = re.compile(r'(?:^|;)\s*(gene_id|gene_name|transcript_id|exon_id)\s+(?:"([^"]*)"|([^\s;]+))')
 
 cdef int skip_header(str filename):
     """Return the number of lines starting with `#`."""
@@ -65,20 +74,26 @@ cdef int skip_header(str filename):
             n += 1
     return n
 
-def parse_gtf(str line,str gtf_ftype):
-    """Parse one GTF line. Return None if not an 'exon'. Return False if *line* is empty."""
+def parse_gtf(str line,str gtf_ftype,object genes=None):
+    """Parse one GTF line. Return None if not an 'exon', or if its gene is not in *genes*
+    (a set of gene IDs and names) when given. Return False if *line* is empty."""
     # GTF fields = ['chr','source','name','start','end','score','strand','frame','attributes']
     cdef list row
     if (not line): return False
+    exon_nr = next(Ecounter)  # line number, whether or not it is kept
+    if ("\t%s\t" % gtf_ftype) not in line:  # cheap reject before splitting
+        return None
     row = line.strip().split("\t")
     if len(row) < 9:
         raise ValueError("\"Attributes\" field required in GFF.")
     if row[2] != gtf_ftype:
         return None
-    attrs = tuple(x.strip().split() for x in row[8].rstrip(';').split(';'))  # {gene_id: "AAA", ...}
-    attrs = dict((x[0],x[1].strip("\"")) for x in attrs)
-    exon_nr = next(Ecounter)
-    exon_id = attrs.get('exon_id', 'E%d'%exon_nr)
+    attrs = dict((k,q or u) for k,q,u in _attrs_re.findall(row[8]))  # {gene_id: "AAA", ...}
+    if genes is not None and attrs.get('gene_id') not in genes and attrs.get('gene_name') not in genes:
+        return None
+    exon_id = attrs.get('exon_id')
+    if exon_id is None:  # only format a default name when the GTF has no exon_id
+        exon_id = 'E%d'%exon_nr
     start = max(int(row[3])-1,0)
     end = max(int(row[4]),0)
     return GenomicObject(id=(exon_nr,),
@@ -87,24 +102,28 @@ def parse_gtf(str line,str gtf_ftype):
         name=exon_id, strand=_strand(row[6]), ftype="exon",
         transcripts=set([attrs.get('transcript_id',exon_id)]))
 
-def parse_bed(str line,str gtf_ftype):
-    """Parse one BED line. Return False if *line* is empty."""
+def parse_bed(str line,str gtf_ftype,object genes=None):
+    """Parse one BED line. Return None if its name is not in *genes*, when given.
+    Return False if *line* is empty."""
     cdef list row
     cdef int start,end,strand
     cdef str name
     cdef double score
-    if (not line) or (line[0]=='#') or (line[:5]=='track'): return False
+    if (not line): return False
+    exon_nr = next(Ecounter)  # line number, whether or not it is kept
+    if (line[0]=='#') or (line[:5]=='track'): return False
     row = line.strip().split()
     lrow = len(row)
     assert lrow >=4, "Input BED format requires at least 4 fields: %s" % line
     chrom = row[0]; start = int(row[1]); end = int(row[2]); name = row[3]
+    if genes is not None and name not in genes:
+        return None
     strand = 0
     if lrow > 4:
         if lrow > 5: strand = _strand(row[5])
         else: strand = 0
         score = _score(row[4])
     else: score = 0.0
-    exon_nr = next(Ecounter)
     return GenomicObject(id=(exon_nr,), gene_id=name, gene_name=name,
         chrom=chrom, start=start, end=end, length=end-start,
         name=name, score=score, strand=strand, ftype="exon", transcripts=set([name]))
@@ -155,7 +174,7 @@ cdef class GenomicObject(object):
         tuple id
         str gene_id,gene_name,chrom,name,ftype,synonyms
         int start,end,strand,length,multiplicity
-        double score,count,count_anti,rpk,rpk_anti,NH,v
+        double score,count,count_anti,rpk,rpk_anti
         set transcripts,exons
     def __init__(self, tuple id=(0,), str gene_id='', str gene_name='',
              str chrom='', int start=0, int end=0, str name='', str ftype='', str synonyms='.',
@@ -182,12 +201,20 @@ cdef class GenomicObject(object):
         self.exons = exons
         self.length = length
 
+    def __copy__(self):
+        """Shallow copy - needed by copy.copy() for this extension type."""
+        return GenomicObject(id=self.id, gene_id=self.gene_id, gene_name=self.gene_name,
+            chrom=self.chrom, start=self.start, end=self.end, name=self.name, ftype=self.ftype,
+            synonyms=self.synonyms, score=self.score, strand=self.strand, length=self.length,
+            multiplicity=self.multiplicity, count=self.count, count_anti=self.count_anti,
+            rpk=self.rpk, rpk_anti=self.rpk_anti, transcripts=self.transcripts, exons=self.exons)
+
     def __and__(self,other):
         """The intersection of two GenomicObjects"""
         return GenomicObject(
             id = self.id + other.id,
-            gene_id = '|'.join(set([self.gene_id, other.gene_id])),
-            gene_name = '|'.join(set([self.gene_name, other.gene_name])),
+            gene_id = '|'.join(sorted(set([self.gene_id, other.gene_id]))),
+            gene_name = '|'.join(sorted(set([self.gene_name, other.gene_name]))),
             chrom = self.chrom,
             name = '|'.join([self.name, other.name]),
             strand = (self.strand + other.strand)/2,
@@ -196,18 +223,11 @@ cdef class GenomicObject(object):
             ftype = "exon"
         )
 
-    cpdef increment(self,double x,object alignment,bint multiple,bint stranded):
-        if multiple:
-            NH = 1.0
-            for (k,v) in alignment.tags:
-                if k=='NH':
-                    NH = 1.0/v
-                    break
-            x = x * NH
+    cpdef increment(self,double x,bint reverse,bint stranded):
+        """Add *x* to the count. *reverse* is the read strand, used if *stranded*."""
         if stranded:
             # read/exon strand mismatch
-            if (alignment.is_reverse is False and self.strand == 1) \
-            or (alignment.is_reverse is True and self.strand == -1):
+            if (not reverse and self.strand == 1) or (reverse and self.strand == -1):
                 self.count += x
             else:
                 self.count_anti += x
@@ -222,38 +242,75 @@ cdef class GenomicObject(object):
 
 
 cdef GenomicObject intersect_exons_list(list feats):
-    """The intersection of a list *feats* of GenomicObjects."""
-    cdef GenomicObject f
+    """The intersection of a list *feats* of GenomicObjects.
+    Same as reducing with `&`, but builds a single object in one pass."""
+    cdef GenomicObject f, f0
+    cdef set transcripts, gene_ids, gene_names
+    cdef int strand, multiplicity
     feats = list(set(feats))
-    f = feats[0]
-    if len(feats) == 1:
-        return f.__and__(f)
-    else:
-        return reduce(GenomicObject.__and__, feats)
+    f0 = feats[0]
+    if len(feats) == 1:  # a fresh copy, without the merging below
+        return GenomicObject(id=f0.id, gene_id=f0.gene_id, gene_name=f0.gene_name,
+            chrom=f0.chrom, name=f0.name, strand=f0.strand, multiplicity=f0.multiplicity,
+            transcripts=set(f0.transcripts), ftype="exon")
+    strand = f0.strand
+    multiplicity = 0
+    transcripts = set(); gene_ids = set(); gene_names = set()
+    for f in feats:
+        transcripts |= f.transcripts
+        gene_ids.add(f.gene_id)
+        gene_names.add(f.gene_name)
+        multiplicity += f.multiplicity
+        if f.strand != strand: strand = 0
+    return GenomicObject(
+        id = tuple(itertools.chain.from_iterable([f.id for f in feats])),
+        gene_id = '|'.join(sorted(gene_ids)),
+        gene_name = '|'.join(sorted(gene_names)),
+        chrom = f0.chrom,
+        name = '|'.join([f.name for f in feats]),
+        strand = strand,
+        multiplicity = multiplicity,
+        transcripts = transcripts,
+        ftype = "exon"
+    )
 
 cdef list cobble(list exons):
     """Split exons into non-overlapping parts."""
-    cdef list ends, active_exons, cobbled
+    cdef list cobbled
+    cdef set active
+    cdef dict cache
+    cdef frozenset key
     cdef GenomicObject e
-    cdef tuple a,b
-    cdef int i
-    ends = [(e.start,1,e) for e in exons] + [(e.end,0,e) for e in exons]
-    ends.sort()
-    active_exons = []
+    cdef Py_ssize_t n, k, i, j
+    cdef cnp.ndarray[cnp.int64_t, ndim=1] pos
+    cdef cnp.ndarray[cnp.intp_t, ndim=1] order
+    n = len(exons)
+    if n == 0: return []
+    # Boundaries: starts at [0,n), ends at [n,2n). Sorted by position, ends before starts.
+    pos = np.array([e.start for e in exons] + [e.end for e in exons], dtype=np.int64)
+    order = np.lexsort((np.repeat(np.array([1,0], dtype=np.int8), n), pos))
+    active = set()  # indices of the exons overlapping the current position
+    cache = {}      # {frozenset(active): intersection} - nested exons give back the same set
     cobbled = []
-    for i in range(len(ends)-1):
-        a = ends[i]
-        b = ends[i+1]
-        if a[1]==1:
-            active_exons.append(a[2])
-        elif a[1]==0:
-            active_exons.remove(a[2])
-        if len(active_exons)==0:
+    for k in range(2*n-1):
+        i = order[k]
+        j = order[k+1]
+        if i < n:
+            active.add(i)
+        else:
+            active.discard(i-n)
+        if not active:
             continue
-        if a[0]==b[0]:
+        if pos[i] == pos[j]:
             continue
-        e = intersect_exons_list(active_exons)
-        e.start = a[0]; e.end = b[0]; e.length = b[0]-a[0]
+        key = frozenset(active)
+        if key in cache:
+            e = copy.copy(cache[key])
+            e.transcripts = set(e.transcripts)
+        else:
+            e = intersect_exons_list([exons[x] for x in active])
+            cache[key] = e
+        e.start = pos[i]; e.end = pos[j]; e.length = pos[j]-pos[i]
         cobbled.append(e)
     return cobbled
 
@@ -278,7 +335,7 @@ cdef list partition_chrexons(list chrexons):
     - from the GTF we don't know how many and how far."""
     cdef int lastend, lastindex, npart, i, lp
     cdef list partition, parts
-    cdef dict pinvgenes
+    cdef object pinvgenes
     cdef set lastgeneids, toremove
     cdef GenomicObject exon
     cdef str g
@@ -286,7 +343,7 @@ cdef list partition_chrexons(list chrexons):
     lastgeneids = set([chrexons[0].gene_id])
     lastindex = 0
     partition = []
-    pinvgenes = {}  # map {gene_id: partitions it is found in}
+    pinvgenes = defaultdict(list)  # map {gene_id: partitions it is found in}
     npart = 0       # partition index
     # First cut (where disjoint, except if the same gene continues)
     for i,exon in enumerate(chrexons):
@@ -295,7 +352,7 @@ cdef list partition_chrexons(list chrexons):
             partition.append((lastindex,i))
             # Record in which parts the gene was found, fuse them later
             for g in lastgeneids:
-                pinvgenes.setdefault(g,[]).append(npart)
+                pinvgenes[g].append(npart)
             npart += 1
             lastgeneids.clear()
             lastindex = i
@@ -304,7 +361,7 @@ cdef list partition_chrexons(list chrexons):
         lastgeneids.add(exon.gene_id)
     partition.append((lastindex,len(chrexons)))
     for g in lastgeneids:
-        pinvgenes.setdefault(g,[]).append(npart)
+        pinvgenes[g].append(npart)
     # Put together intervals containing parts of the same gene mixed with others - if any
     mparts = [[p[0],p[len(p)-1]] for p in pinvgenes.values() if len(p)>1]
     if mparts:
@@ -362,24 +419,32 @@ cdef int count_reads(list exons,object ckreads,bint multiple,bint stranded) exce
     :param stranded: for strand-specific protocols, use the strand information."""
     cdef int current_idx, idx2, pos, ali_pos, nexons
     cdef int exon_start, exon_end, shift, op, ali_len, read_len
+    cdef double NH
+    cdef bint reverse
     cdef object alignment
     cdef GenomicObject E1, E2
+    cdef cnp.ndarray[cnp.int64_t, ndim=1] ends
     current_idx = 0
     nexons = len(exons)
+    if nexons == 0: return 0
+    # Pieces are disjoint and sorted, so are their ends
+    ends = np.array([E1.end for E1 in exons], dtype=np.int64)
     for alignment in ckreads:
-        if current_idx >= nexons: return 0
-        E1 = exons[current_idx]
-        exon_end = E1.end
         ali_pos = alignment.pos
-        while exon_end <= ali_pos:
+        # Two-pointer sweep: reads come sorted by position, so the first piece
+        # ending after the read start can only move forward. Typed loop, no Python call.
+        while ends[current_idx] <= ali_pos:
             current_idx += 1
             if current_idx >= nexons: return 0
-            E1 = exons[current_idx]
-            exon_end = E1.end
         idx2 = current_idx
         E2 = exons[idx2]
         exon_start = E2.start
+        exon_end = E2.end
         read_len = alignment.rlen
+        reverse = alignment.is_reverse
+        NH = 1.0
+        if multiple and alignment.has_tag('NH'):
+            NH = 1.0/alignment.get_tag('NH')
         ali_len = 0
         for op,shift in alignment.cigar:
             if op in [0,2,3]:  # [BAM_CMATCH,BAM_CDEL,BAM_CREF_SKIP]
@@ -393,7 +458,7 @@ cdef int count_reads(list exons,object ckreads,bint multiple,bint stranded) exce
                     # Score up to exon end, go to exon end, remove from shift and reset ali_len
                     if op == 0:
                         ali_len += exon_end - ali_pos
-                        E2.increment(float(ali_len)/float(read_len), alignment, multiple,stranded)
+                        E2.increment(float(ali_len)/float(read_len)*NH, reverse,stranded)
                     shift -= exon_end-ali_pos
                     ali_pos = exon_end
                     ali_len = 0
@@ -416,21 +481,32 @@ cdef int count_reads(list exons,object ckreads,bint multiple,bint stranded) exce
             elif op == 1:  # BAM_CINS
                 ali_len += shift;
         # If read entirely contained in exon, ali_len==shift and we do a single increment
-        E2.increment(float(ali_len)/float(read_len), alignment, multiple,stranded)
+        E2.increment(float(ali_len)/float(read_len)*NH, reverse,stranded)
     return 0
 
 
 ######################  Expression inference  #######################
 
 
-cdef inline bint is_in(str ftype,GenomicObject x,str feat_id):
-    """Returns True if piece *x* is part of the gene/transcript *feat_id*."""
+cdef inline object feat_ids(str ftype,GenomicObject x):
+    """Returns the IDs of all genes/transcripts piece *x* is part of."""
     if ftype == "transcript":
-        return feat_id in x.transcripts
+        return x.transcripts
     elif ftype == "gene":
-        return feat_id in x.gene_id.split('|')
+        return x.gene_id.split('|')
     else:
-        return feat_id in x.name.split('|')
+        return x.name.split('|')
+
+cdef object group_by_feat(str ftype,list objs):
+    """Returns a map {feat_id: [objects of *objs* that are part of it]}, in the order
+    of *objs*. Built in one pass instead of scanning *objs* again for every ID."""
+    cdef GenomicObject x
+    cdef object groups
+    groups = defaultdict(list)
+    for x in objs:
+        for f in set(feat_ids(ftype,x)):
+            groups[f].append(x)
+    return groups
 
 
 cdef list estimate_expression_NNLS(str ftype,list pieces,list ids,list exons,double norm_cst,bint stranded):
@@ -444,22 +520,30 @@ cdef list estimate_expression_NNLS(str ftype,list pieces,list ids,list exons,dou
     cdef int n,m,flen,i,j
     cdef double rnorm, fcount, frpk, fcount_anti, frpk_anti
     cdef str f
-    cdef cnp.ndarray[DTYPE_t, ndim=2] A, W
+    cdef cnp.ndarray[cnp.float32_t, ndim=2] S
+    cdef cnp.ndarray[DTYPE_t, ndim=2] A
     cdef cnp.ndarray[DTYPE_t, ndim=1] E, T, w
     cdef GenomicObject p
-    cdef list exs, feats
+    cdef list exs, feats, rows, cols
+    cdef object fidx, f2e, f2p
     n = len(pieces)
     m = len(ids)
-    A = zeros((n,m))
+    # Scatter ones at (piece, feature) pairs instead of testing all n*m cells
+    fidx = defaultdict(list)  # {feat_id: [column indices]}
+    for j,f in enumerate(ids):
+        fidx[f].append(j)
+    rows = []; cols = []
     for i,p in enumerate(pieces):
-        for j,f in enumerate(ids):
-            if is_in(ftype,p,f): A[i,j] = 1.
+        for f in feat_ids(ftype,p):
+            for j in fidx.get(f,()):
+                rows.append(i); cols.append(j)
+    S = zeros((n,m), dtype=np.float32)  # 0/1 entries, exact in single precision
+    S[rows,cols] = 1.
     #--- Build the exons scores vector
     E = array([p.rpk for p in pieces])
     # Weights
     w = sqrt(array([p.length for p in pieces]))
-    W = diag(w)
-    A = dot(W,A)
+    A = S * w[:,None]  # same as dot(diag(w),S), without the n*n diagonal matrix
     E = multiply(E, w)
     #--- Solve for RPK
     T,rnorm = nnls(A,E)
@@ -470,9 +554,11 @@ cdef list estimate_expression_NNLS(str ftype,list pieces,list ids,list exons,dou
     #--- Store result in a list of GenomicObject
     feats = []
     frpk_anti = fcount_anti = 0.0
+    f2e = group_by_feat(ftype,exons)
+    f2p = group_by_feat(ftype,pieces)
     for i,f in enumerate(ids):
-        exs = sorted([e for e in exons if is_in(ftype,e,f)], key=attrgetter('start','end'))
-        inner = [p for p in pieces if is_in(ftype,p,f)]
+        exs = sorted(f2e[f], key=attrgetter('start','end'))
+        inner = f2p[f]
         flen = sum([p.length for p in cobble(inner)])
         frpk = T[i]
         fcount = fromRPK(T[i],flen,norm_cst)
@@ -496,11 +582,14 @@ cdef list estimate_expression_raw(str ftype,list pieces,list ids,list exons,doub
     cdef str f
     cdef GenomicObject p
     cdef list inner, feats
+    cdef object f2e, f2p
     feats = []
     frpk_anti = fcount_anti = 0.0
+    f2e = group_by_feat(ftype,exons)
+    f2p = group_by_feat(ftype,[p for p in pieces if '|' not in p.gene_id])
     for i,f in enumerate(ids):
-        exs = sorted([e for e in exons if is_in(ftype,e,f)], key=attrgetter('start','end'))
-        inner = [p for p in pieces if (len(p.gene_id.split('|'))==1 and is_in(ftype,p,f))]
+        exs = sorted(f2e[f], key=attrgetter('start','end'))
+        inner = f2p[f]
         if len(inner)==0:
             flen = 0
             fcount = frpk = 0.0
@@ -525,12 +614,14 @@ cdef list genes_from_transcripts(list transcripts,list pieces):
     cdef GenomicObject t0, x
     cdef str k
     cdef int glen
+    cdef object g2p
     genes = []
     transcripts.sort(key=attrgetter("gene_id","start","end"))
+    g2p = group_by_feat("gene",pieces)
     for k,group in itertools.groupby(transcripts, key=attrgetter("gene_id")):
         g = list(group)
         t0 = g[0]
-        inner = [p for p in pieces if is_in("gene",p,k)]
+        inner = g2p[k]
         glen = sum([p.length for p in cobble(inner)])
         genes.append(GenomicObject(name=t0.gene_id, ftype="gene",
                 rpk=sum([x.rpk for x in g]), rpk_anti=sum([x.rpk_anti for x in g]),
@@ -548,20 +639,21 @@ cdef inline str simplify(str name):
     """Removes duplicates in names of the form 'name1|name2', and sorts elements."""
     return '|'.join(sorted(set(name.split('|'))))
 
-cdef dict filter_transcripts(dict t2p,int exon_cutoff):
+cdef dict filter_transcripts(object t2p,int exon_cutoff):
     """*t2p* is a map {transcriptID: [exon pieces]}.
     Find transcripts that differ from others by exon parts of less than
     one read length."""
-    cdef dict structs, replace
+    cdef dict replace
+    cdef object structs
     cdef str t, main
     cdef list texons, tlist
     cdef GenomicObject te
     cdef tuple filtered_ids, f, structure
-    structs = {}  # transcript structures, as tuples of exon ids
+    structs = defaultdict(list)  # transcript structures, as tuples of exon ids
     replace = {} # too close transcripts
     for t,texons in sorted(t2p.items(), key=itemgetter(0)):
         structure = tuple([te.id for te in texons if te.length > exon_cutoff])
-        structs.setdefault(structure, []).append(t)
+        structs[structure].append(t)
     for f,tlist in structs.items():
         tlist.sort()
         main = tlist[0]
@@ -578,9 +670,11 @@ def process_chunk(list ckexons,object sam,str chrom,dict options):
     cdef int method, lastend, fraglength, exon_cutoff, i
     cdef GenomicObject exon0, gr, p, e, gene, trans
     cdef list exons, exons2, introns, introns2, genes, transcripts
-    cdef list exon_names, transcript_ids, gene_ids, intron_ids, exon_ids
+    cdef list transcript_ids, gene_ids, intron_ids, exon_ids
     cdef list pieces, pieces2, tpieces, types, syns
-    cdef dict t2p, methods, synonyms
+    cdef dict methods
+    cdef set gids, exon_names
+    cdef object t2p, tlen, synonyms
     cdef str t, tid, synonym
     cdef bint stranded
     cdef double norm_cst, threshold
@@ -596,38 +690,38 @@ def process_chunk(list ckexons,object sam,str chrom,dict options):
 
     #--- Regroup occurrences of the same exons from a different transcript
     exons = []
+    gids = set(); exon_names = set()
     for key,group in itertools.groupby(ckexons, attrgetter('name')):
         # ckexons are sorted by id because chrexons were sorted by chrom,start,end
         exon0 = next(group)
         for gr in group:
             exon0.transcripts.add(gr.transcripts.pop())
         exons.append(exon0)
-    gene_ids = sorted(set(e.gene_id for e in exons))
-    exon_names = sorted(set(e.name for e in exons))
+        gids.add(exon0.gene_id)
+        exon_names.add(exon0.name)
+    gene_ids = sorted(gids)
 
     #--- Cobble all these intervals
     pieces = cobble(exons)  # sorted
 
     #--- Filter out too similar transcripts
-    t2p = {}
-    synonyms = {}
-    for p in pieces:
+    t2p = defaultdict(list)
+    tlen = defaultdict(int)  # transcript lengths, still valid after filtering
+    synonyms = defaultdict(set)
+    for p in pieces:  # single walk over the pieces
+        p.name = simplify(p.name)  # remove duplicates in names
         for t in p.transcripts:
-            t2p.setdefault(t,[]).append(p)
+            t2p[t].append(p)
+            tlen[t] += p.length
     if (1 in types) or (3 in types) or (0 in types and methods[0]==2):
         replace = filter_transcripts(t2p, exon_cutoff)
         for p in pieces + exons:
             p.transcripts = set([replace[t] for t in p.transcripts])
         for t,main in replace.items():
-            synonyms.setdefault(main, set()).add(t)
+            synonyms[main].add(t)
     transcript_ids = sorted(t2p.keys())  # sort to have the same order in all outputs from same gtf
 
-    #--- Count reads in each piece
-    lastend = max(e.end for e in exons)
-    ckreads = sam.fetch(chrom, exons[0].start, lastend)
-    count_reads(pieces,ckreads,options['nh'],stranded)
-
-    #--- Same for introns, if selected
+    #--- Build intron pieces, if selected
     intron_pieces = []
     if 3 in types:
         introns = []
@@ -639,23 +733,26 @@ def process_chunk(list ckexons,object sam,str chrom,dict options):
             intron_pieces = [ip for ip in intron_exon_pieces if \
                              # ip.length > exon_cutoff and \
                              not any([n in exon_names for n in ip.name.split('|')])]
-            if intron_pieces:
-                lastend = max([intron.end for intron in introns])
-                ckreads = sam.fetch(chrom, intron_pieces[0].start, lastend)
-                count_reads(intron_pieces,ckreads,options['nh'],stranded)
         for i,ip in enumerate(intron_pieces):
             ip.ftype = "intron"
 
+    #--- Count reads in each piece - a single fetch, since introns lie within [exons[0].start, lastend]
+    lastend = max(e.end for e in exons)
+    ckreads = list(sam.fetch(chrom, exons[0].start, lastend))
+    count_reads(pieces,ckreads,options['nh'],stranded)
+    if intron_pieces:
+        # Separate pass: count_reads carries a read over to the next pieces, which must not
+        # mix exons and introns. Skip the reads that end before the first intron.
+        count_reads(intron_pieces,[r for r in ckreads if r.aend > intron_pieces[0].start],
+                    options['nh'],stranded)
+
     #--- Calculate RPK
     for p in itertools.chain(pieces,intron_pieces):
         p.rpk = toRPK(p.count,p.length,norm_cst)
-    if stranded:
-        for p in itertools.chain(pieces,intron_pieces):
+        if stranded:
             p.rpk_anti = toRPK(p.count_anti,p.length,norm_cst)
 
     #--- Infer gene/transcript counts
-    for p in pieces:
-        p.name = simplify(p.name)  # remove duplicates in names
     genes=[]; transcripts=[]; exons2=[]; introns2=[]; pieces2=[]
     # Transcripts - 1
     if 1 in types:
@@ -665,7 +762,7 @@ def process_chunk(list ckexons,object sam,str chrom,dict options):
         elif method == 0:
             transcripts = estimate_expression_raw("transcript",pieces,transcript_ids,exons,norm_cst,stranded)
         for i,trans in enumerate(transcripts):
-            trans.length = sum([p.length for p in t2p[trans.name]])
+            trans.length = tlen[trans.name]
             trans.rpk = correct_fraglen_bias(trans.rpk, trans.length, fraglength)
             syns = sorted(list(synonyms.get(trans.name, [])))
             toadd = []
@@ -738,6 +835,63 @@ def write_output(output, genes,transcripts,exons,introns,pieces, threshold,stran
             output.write('\t'.join(towrite)+'\n')
 
 
+def process_chrexons(chrexons, sam, chrom, options):
+    """Partition all exons *chrexons* of chromosome *chrom* in independent chunks
+    and process each of them."""
+    chrexons.sort(key=attrgetter('start','end','name'))
+    if options['stranded']:
+        chrexons_plus = [x for x in chrexons if x.strand == 1]
+        chrexons_minus = [x for x in chrexons if x.strand == -1]
+        if len(chrexons_plus) > 0:
+            partition_plus = partition_chrexons(chrexons_plus)
+            for (a,b) in partition_plus:
+                process_chunk(chrexons_plus[a:b], sam, chrom, options)
+        if len(chrexons_minus) > 0:
+            partition_minus = partition_chrexons(chrexons_minus)
+            for (a,b) in partition_minus:
+                process_chunk(chrexons_minus[a:b], sam, chrom, options)
+    else:
+        partition = partition_chrexons(chrexons)
+        for (a,b) in partition:
+            process_chunk(chrexons[a:b], sam, chrom, options)
+
+
+def chrom_rows(annot, chromosomes):
+    """Group the non-empty lines of *annot* by chromosome, keeping those in *chromosomes*.
+    Yields tuples (chrom, rows, first) where *first* is the number of the first of *rows*
+    in the annotation, as counted by parse_gtf() and parse_bed() (see Ecounter)."""
+    rows = enumerate((row for row in annot if row.strip()), 1)
+    for chrom,chrrows in itertools.groupby(rows, lambda x: x[1].split(None,1)[0]):
+        if chrom in chromosomes:
+            chrrows = list(chrrows)
+            yield chrom, [row for i,row in chrrows], chrrows[0][0]
+
+def parse_chrom_rows(rows, first, options):
+    """Parse the annotation lines *rows* of one chromosome, the first one being
+    line number *first*. Returns the usable exons."""
+    global Ecounter
+    Ecounter = itertools.count(first)  # same default exon ids whatever is parsed before
+    if options['format'] == 'gtf':
+        parse = parse_gtf
+    elif options['format'] == 'bed':
+        parse = parse_bed
+    chrexons = (parse(row.strip(), options['gtf_ftype'], options['genes']) for row in rows)
+    return [e for e in chrexons if e and (e.end - e.start > 1)]
+
+def process_chrom_rows(job):
+    """Used with --nproc > 1. *job* is a tuple (bamname, chrom, rows, first, options),
+    see chrom_rows(). Returns what would have been written to the output, as a string,
+    and the number of exons parsed."""
+    bamname, chrom, rows, first, options = job
+    chrexons = parse_chrom_rows(rows, first, options)
+    options['output'] = StringIO()
+    if chrexons:
+        sam = pysam.Samfile(bamname, "rb")  # pysam handles cannot be shared between processes
+        process_chrexons(chrexons, sam, chrom, options)
+        sam.close()
+    return options['output'].getvalue(), len(chrexons)
+
+
 def rnacounter_main(bamname, annotname, options):
     # Index BAM if necessary
     if not os.path.exists(bamname+'.bai'):
@@ -758,16 +912,11 @@ def rnacounter_main(bamname, annotname, options):
     for _ in range(nhead): annot.readline()
 
     if options['output'] is None: options['output'] = sys.stdout
-    else: options['output'] = open(options['output'], "wb")
+    else: options['output'] = open(options['output'], "w")
     if options['noheader'] is False:
         header = ['ID','Count','RPKM','Chrom','Start','End','Strand','GeneName','Length','Type','Sense','Synonym']
         options['output'].write('\t'.join(header)+'\n')
 
-    if options['format'] == 'gtf':
-        parse = parse_gtf
-    elif options['format'] == 'bed':
-        parse = parse_bed
-
     # Cross 'chromosomes' option with available BAM headers
     if len(options['chromosomes']) > 0:
         chromosomes = [c for c in sam.references if c in options['chromosomes']]
@@ -780,52 +929,35 @@ def rnacounter_main(bamname, annotname, options):
     else:
         options['normalize'] = float(options['normalize'])
 
-    # Initialize
-    gtf_ftype = options['gtf_ftype']
-    chrom = ''
-    while chrom not in chromosomes:
-        exon = None
-        while exon is None:
-            row = annot.readline().strip()
-            exon = parse(row, gtf_ftype)  # None if not an exon, False if EOF
-        if not row: break
-        chrom = exon.chrom
-    if chrom == '':
-        raise ValueError("Reference names in BAM do not correspond to that of the GTF.")
-    lastchrom = chrom
-
     # Process together all exons of one chromosome at a time
-    while row:
-        chrexons = []
-        while chrom == lastchrom:
-            if (exon.end - exon.start > 1) and (exon.chrom in chromosomes):
-                chrexons.append(exon)
-            # Fetch next exon
-            exon = None
-            while exon is None:
-                row = annot.readline().strip()
-                exon = parse(row, gtf_ftype)  # None if not an exon, False if EOF
-            if not row: break
-            chrom = exon.chrom
-        if chrexons:
-            chrexons.sort(key=attrgetter('start','end','name'))
-            if options['stranded']:
-                chrexons_plus = [x for x in chrexons if x.strand == 1]
-                chrexons_minus = [x for x in chrexons if x.strand == -1]
-                if len(chrexons_plus) > 0:
-                    partition_plus = partition_chrexons(chrexons_plus)
-                    for (a,b) in partition_plus:
-                        process_chunk(chrexons_plus[a:b], sam, lastchrom, options)
-                if len(chrexons_minus) > 0:
-                    partition_minus = partition_chrexons(chrexons_minus)
-                    for (a,b) in partition_minus:
-                        process_chunk(chrexons_minus[a:b], sam, lastchrom, options)
-            else:
-                if len(chrexons) > 0:
-                    partition = partition_chrexons(chrexons)
-                    for (a,b) in partition:
-                        process_chunk(chrexons[a:b], sam, lastchrom, options)
-        lastchrom = chrom
+    nchrom = nexons = 0
+    if options['nproc'] > 1:
+        # Workers parse the rows of one chromosome each and open their own BAM handle;
+        # outputs are written in the order of the annotation.
+        jobs = ((bamname, chrom, rows, first, dict(options, output=None))
+                for chrom,rows,first in chrom_rows(annot, chromosomes))
+        pool = multiprocessing.Pool(options['nproc'])
+        try:
+            for out,n in pool.imap(process_chrom_rows, jobs):
+                nchrom += 1
+                nexons += n
+                options['output'].write(out)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chrom,rows,first in chrom_rows(annot, chromosomes):
+            nchrom += 1
+            chrexons = parse_chrom_rows(rows, first, options)
+            nexons += len(chrexons)
+            if chrexons:
+                process_chrexons(chrexons, sam, chrom, options)
+    if nchrom == 0:
+        raise ValueError("Reference names in BAM do not correspond to that of the GTF.")
+    if nexons == 0:
+        if options['genes'] is not None:
+            raise ValueError("No annotation line matches --genes.")
+        raise ValueError("No '%s' found in the annotation." % options['gtf_ftype'])
 
     options['output'].close()
     annot.close()
@@ -845,6 +977,7 @@ def errmsg(message):
 def parse_args(args):
     if args['--chromosomes'] is None: args['--chromosomes'] = []
     else: args['--chromosomes'] = args['--chromosomes'].split(',')
+    if args['--genes'] is not None: args['--genes'] = set(args['--genes'].split(','))
 
     if args['--format'].lower() not in ['gtf','bed']:
         errmsg("FORMAT must be one of 'gtf' or 'bed'.")
@@ -880,6 +1013,8 @@ def parse_args(args):
     except ValueError: errmsg("--threshold must be numeric.")
     try: args['--fraglength'] = int(args['--fraglength'])
     except ValueError: errmsg("FRAGLENGTH must be an integer.")
+    try: args['--nproc'] = max(int(args['--nproc']), 1)
+    except ValueError: errmsg("--nproc must be an integer.")
     if args['--exon_cutoff']:
         try: args['--exon_cutoff'] = int(args['--exon_cutoff'])
         except ValueError: errmsg("--exon_cutoff must be an integer.")
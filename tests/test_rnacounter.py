@@ -13,7 +13,7 @@ __test__ = True
 
 
 from rnacounter.draft_nocython import *
-import pysam
+import pysam, docopt, tempfile, shutil
 
 bamtest = os.path.abspath(resource_filename('testfiles', 'gapdhKO.bam'))
 gtftest =  os.path.abspath(resource_filename('testfiles', 'mm9_3genes_renamed.gtf'))
@@ -23,7 +23,32 @@ class Test_Parse_GTF(unittest.TestCase):
     def setUp(self):
         pass
     def test_parse_gtf(self):
-        pass
+        line = 'chr6\tprotein_coding\texon\t125095259\t125096047\t.\t+\t.\tgene_id "G1"; ' \
+               'transcript_id "T1"; exon_number "1"; gene_name "g1"; exon_id "E1"'
+        exon = parse_gtf(line, 'exon')
+        self.assertEqual((exon.chrom, exon.start, exon.end, exon.strand), ('chr6', 125095258, 125096047, 1))
+        self.assertEqual((exon.gene_id, exon.gene_name, exon.name), ('G1', 'g1', 'E1'))
+        self.assertEqual(exon.transcripts, set(['T1']))
+        self.assertIsNone(parse_gtf(line.replace('\texon\t','\tCDS\t'), 'exon'))
+        self.assertFalse(parse_gtf('', 'exon'))
+        # Unquoted values, and quoted values containing a semicolon
+        line = 'chr6\tprotein_coding\texon\t10\t20\t.\t+\t.\tgene_id G1 ; transcript_id T1 ; gene_name "a;b"'
+        exon = parse_gtf(line, 'exon')
+        self.assertEqual((exon.gene_id, exon.gene_name), ('G1', 'a;b'))
+        self.assertEqual(exon.transcripts, set(['T1']))
+    def test_parse_gtf_genes(self):
+        line = 'chr6\tprotein_coding\texon\t10\t20\t.\t-\t.\tgene_id "G1"; transcript_id "T1"; gene_name "g1";'
+        self.assertEqual(parse_gtf(line, 'exon', set(['g1'])).gene_id, 'G1')
+        self.assertEqual(parse_gtf(line, 'exon', set(['G1'])).gene_id, 'G1')
+        self.assertIsNone(parse_gtf(line, 'exon', set(['G2','g2'])))
+    def test_parse_bed(self):
+        line = 'chr6\t10\t20\tG1\t5\t-'
+        exon = parse_bed(line, 'exon')
+        self.assertEqual((exon.chrom, exon.start, exon.end, exon.strand), ('chr6', 10, 20, -1))
+        self.assertEqual((exon.gene_id, exon.name, exon.score), ('G1', 'G1', 5.0))
+        self.assertEqual(parse_bed(line, 'exon', set(['G1'])).name, 'G1')
+        self.assertIsNone(parse_bed(line, 'exon', set(['G2'])))
+        self.assertFalse(parse_bed('track name=test', 'exon'))
 
 
 class Test_Cobble(unittest.TestCase):
@@ -38,7 +63,7 @@ class Test_Cobble(unittest.TestCase):
         for i in range(len(self.sts)):
             for x in trans:
                 if self.sts[i] in trans[x]: t = x; break
-            self.exons.append(Exon(chrom='c',start=self.sts[i]*10,end=self.ens[i]*10,gene_id='G',gene_name='g',
+            self.exons.append(GenomicObject(chrom='c',start=self.sts[i]*10,end=self.ens[i]*10,gene_id='G',gene_name='g',
                                    name='E%d'%i,strand=-1,transcripts=set([t])))
     def test_add_exons(self):
         newexon = self.exons[1] & self.exons[2]
@@ -61,6 +86,13 @@ class Test_Cobble(unittest.TestCase):
         self.assertListEqual(sorted(cobbled[3].name.split('|')), ['E1','E2','E3'])
         self.assertListEqual(sorted(cobbled[7].name.split('|')), ['E3','E4','E5'])
         self.assertListEqual(sorted(cobbled[11].name.split('|')), ['E5','E6','E7'])
+    def test_cobble_nested(self):
+        # The same set of exons is active again after the nested one: pieces must be distinct
+        cobbled = cobble([self.exons[5], self.exons[7]])   # 80-150, 120-130
+        self.assertListEqual([(x.start,x.end) for x in cobbled], [(80,120),(120,130),(130,150)])
+        self.assertListEqual([sorted(x.name.split('|')) for x in cobbled], [['E5'],['E5','E7'],['E5']])
+        self.assertIsNot(cobbled[0], cobbled[2])
+        self.assertIsNot(cobbled[0].transcripts, cobbled[2].transcripts)
 
 
 class Test_Partition(unittest.TestCase):
@@ -74,7 +106,7 @@ class Test_Partition(unittest.TestCase):
         gene = {'G1':(0,2,8,17,20,26), 'G2':(3,7,11,16,21,27), 'G3':(4,8,12,17,22,28)}
         for i in range(len(self.sts)):
             g = [x for x,v in gene.items() if self.sts[i] in v][0]
-            self.exons.append(Exon(chrom='c', start=self.sts[i]*10, end=self.ens[i]*10,
+            self.exons.append(GenomicObject(chrom='c', start=self.sts[i]*10, end=self.ens[i]*10,
                            gene_id=g, gene_name=g, name='E%d'%i,strand=-1))
     def test_partition_chrexons(self):
         part = partition_chrexons(self.exons)
@@ -97,6 +129,13 @@ class Test_Partition(unittest.TestCase):
         part = partition_chrexons(self.exons)
         self.assertEqual(part, [(0,16)])
 
+    def test_partition_chrexons_nested(self):
+        # Short exons nested in a long one, with a gap between them, stay in the same chunk
+        exons = [GenomicObject(chrom='c', start=s, end=e, gene_id=g, gene_name=g, name='E%d'%i, strand=1)
+                 for i,(s,e,g) in enumerate([(0,100,'G1'),(10,20,'G2'),(30,40,'G3'),(150,160,'G4')])]
+        part = partition_chrexons(exons)
+        self.assertEqual(part, [(0,3),(3,4)])
+
 
 class Test_Counting(unittest.TestCase):
     def setUp(self):
@@ -111,8 +150,28 @@ class Test_Counting(unittest.TestCase):
         self.assertEqual(cnt2,cnt)
 
     def test_count_reads(self):
-        # count_reads(exons,ckreads,multiple,stranded)
-        pass
+        # Exon pieces [0,100) and [500,600), intron [100,500), one read at 80 with an insertion
+        class Sam(object):
+            def fetch(self, chrom, start, end):
+                read = pysam.AlignedSegment()
+                read.reference_start = 80
+                read.query_sequence = 'A'*50
+                read.cigarstring = '30M3I17M'
+                return iter([read])
+        def frag_counts(types):
+            exons = [GenomicObject(chrom='c', start=s, end=e, length=e-s, name=n, gene_id='G', gene_name='g',
+                                   strand=1, ftype='exon', transcripts=set(['T1']))
+                     for (s,e,n) in [(0,100,'E1'),(500,600,'E2')]]
+            options = {'normalize':1.0, 'stranded':False, 'output':StringIO(), 'type':types,
+                       'method':dict((t,0) for t in types), 'threshold':-1, 'fraglength':1,
+                       'exon_cutoff':0, 'nh':False}
+            process_chunk(exons, Sam(), 'c', options)
+            rows = [row.split('\t') for row in options['output'].getvalue().splitlines()]
+            return [(r[0], float(r[1])) for r in rows if r[9] == 'exon_frag']
+        counts = frag_counts([4])
+        assert_almost_equal([c for n,c in counts], [20/50., 3/50.])
+        # Counting introns too does not change exon counts
+        self.assertEqual(frag_counts([4,3]), counts)
     def test_estimate_expression(self):
         #estimate_expression(feat_class, pieces, ids)
         pass
@@ -120,7 +179,45 @@ class Test_Counting(unittest.TestCase):
 
 class Test_Executable(unittest.TestCase):
     def setUp(self):
-        pass
+        # The test annotation without exon_id, on two chromosomes (no read maps to chr1),
+        # plus a gene overlapping Ncapd2
+        self.tmpdir = tempfile.mkdtemp()
+        self.gtf = os.path.join(self.tmpdir, 'noexonid.gtf')
+        with open(gtftest) as f:
+            rows = [re.sub(r'; exon_id "[^"]*"', '', row) for row in f if not row.startswith('#')]
+        rows.append('chr6\tprotein_coding\texon\t125118001\t125119000\t.\t-\t.\t'
+                    'gene_id "GX"; transcript_id "TX"; gene_name "Aaa"\n')
+        with open(self.gtf, 'w') as g:
+            g.writelines([row.replace('chr6\t','chr1\t',1) for row in rows] + rows)
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def run_main(self, *argv):
+        out = os.path.join(self.tmpdir, 'out.txt')
+        args = docopt.docopt(usage_string(), argv=[bamtest, self.gtf, '-o', out] + list(argv))
+        rnacounter_main(bamtest, self.gtf, parse_args(args))
+        with open(out) as f:
+            return f.read()
+    def test_nproc(self):
+        serial = self.run_main('-t', 'exons,genes,introns,exon_frags')
+        parallel = self.run_main('-t', 'exons,genes,introns,exon_frags', '-p', '2')
+        self.assertEqual(parallel, serial)
+        rows = [row.split('\t') for row in serial.splitlines()[1:]]
+        # Default exon ids are unique across chromosomes
+        exons = [r[0] for r in rows if r[9] == 'exon']
+        self.assertEqual(len(exons), 2*186)
+        self.assertEqual(len(set(exons)), len(exons))
+        # Gene names of pieces shared by several genes come in a fixed order
+        shared = set(r[7] for r in rows if '|' in r[7])
+        self.assertEqual(shared, set(['Aaa|Ncapd2']))
+    def test_genes(self):
+        # Gapdh overlaps no other gene: same rows as in a full run
+        full = [row for row in self.run_main('-t', 'genes').splitlines() if '\tGapdh\t' in row]
+        for p in ('1','2'):
+            rows = self.run_main('-t', 'genes', '-g', 'Gapdh', '-p', p).splitlines()[1:]
+            self.assertEqual(rows, full)
+            with self.assertRaises(ValueError) as cm:
+                self.run_main('-g', 'Nope', '-p', p)
+            self.assertIn('--genes', str(cm.exception))
 
 
 #----------------------------------------------#